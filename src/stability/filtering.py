@@ -2,10 +2,34 @@
 Filtering functions
 """
 
+from functools import lru_cache
+
 import numpy as np
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt
 
-from geometry import n_steps_neigh_channels
+
+@lru_cache(maxsize=32)
+def butterworth_sos(low_freq, high_factor, order, sampling_freq):
+    """Second-order sections of a Butterworth band-pass filter
+    Parameters
+    ----------
+    low_freq: int
+        Low pass frequency (Hz)
+    high_factor: float
+        High pass factor (proportion of sampling rate)
+    order: int
+        Order of Butterworth filter
+    sampling_freq: int
+        Sampling frequency (Hz)
+
+    Designs are cached and shared between callers, so the returned
+    array is read-only.
+    """
+    low = float(low_freq)/sampling_freq * 2
+    high = float(high_factor) * 2
+    sos = butter(order, [low, high], btype='band', output='sos')
+    sos.flags.writeable = False
+    return sos
 
 
 def butterworth(ts, low_freq, high_factor, order, sampling_freq):
@@ -23,38 +47,38 @@ def butterworth(ts, low_freq, high_factor, order, sampling_freq):
         Order of Butterworth filter
     sampling_freq: int
         Sampling frequency (Hz)
-    """
-    T, C = ts.shape
 
-    low = float(low_freq)/sampling_freq * 2
-    high = float(high_factor) * 2
-    b, a = butter(order, [low, high], btype='band')
-    fts = np.zeros((T, C))
-
-    for i in xrange(C):
-        fts[:, i] = lfilter(b, a, ts[:, i])
-
-    return fts
+    The filtered time series is float32 for float32 input and the
+    floating point promotion of ts with float32 otherwise, e.g.
+    float32 for int16 recordings.
+    """
+    dtype = np.result_type(ts.dtype, np.float32)
+    sos = butterworth_sos(low_freq, high_factor, order, sampling_freq)
+    return sosfilt(sos.astype(dtype), ts.astype(dtype, copy=False), axis=0)
 
 
-def whitening(ts, neighbors, spike_size):
+def whitening(ts, neighbor_index, spike_size):
     """Spatial whitening filter for time series
     Parameters
     ----------
     ts: np.array
         T x C numpy array, where T is the number of time samples and
         C is the number of channels
+    neighbor_index: np.array
+        C x K padded array of the two steps neighbors of each channel,
+        see geometry.neighbor_index_array
+
+    The whitened time series has the same floating point type as ts.
     """
     # get all necessary parameters from param
     [T, C] = ts.shape
     R = spike_size*2 + 1
     th = 4
-    neighChannels = n_steps_neigh_channels(neighbors, steps=2)
 
     chanRange = np.arange(0, C)
     #timeRange = np.arange(0, T)
     # masked recording
-    spikes_rec = np.ones(ts.shape)
+    spikes_rec = np.ones(ts.shape, dtype=ts.dtype)
     for i in range(0, C):
         #idxCrossing = timeRange[ts[:, i] < -th[i]]
         idxCrossing = np.where(ts[:, i] < -th)[0]
@@ -72,15 +96,23 @@ def whitening(ts, neighbors, spike_size):
         np.matmul(spikes_rec.transpose(), spikes_rec)
     invhalf_var = np.diag(np.power(np.diag(M), -0.5))
     M = np.matmul(np.matmul(invhalf_var, M), invhalf_var)
+    # covariance of the neighborhood of each channel, padded with the
+    # identity so that all neighborhoods are whitened in one batch
+    K = neighbor_index.shape[1]
+    valid = neighbor_index >= 0
+    ch_idx = np.where(valid, neighbor_index, 0)
+    M_neigh = M[ch_idx[:, :, np.newaxis], ch_idx[:, np.newaxis, :]]
+    M_neigh[~np.logical_and(valid[:, :, np.newaxis],
+                            valid[:, np.newaxis, :])] = 0
+    M_neigh[:, np.arange(K), np.arange(K)] += ~valid
+    V, D, _ = np.linalg.svd(M_neigh)
+    Epsilon = 1/np.power((D), 0.5)
+    Q_small = np.matmul(V*Epsilon[:, np.newaxis, :],
+                        np.transpose(V, [0, 2, 1]))
+    # row of each neighborhood that belongs to the channel itself
+    own = np.argmax(neighbor_index == chanRange[:, np.newaxis], axis=1)
     Q = np.zeros((C, C))
-    for c in range(0, C):
-        ch_idx = chanRange[neighChannels[c, :]]
-        V, D, _ = np.linalg.svd(M[ch_idx, :][:, ch_idx])
-        eps = 1e-6
-        #Epsilon = np.diag(1/np.power((D + eps), 0.5))
-        Epsilon = np.diag(1/np.power((D), 0.5))
-        #Q_small       = np.matmul(V, np.matmul(Epsilon, V.transpose()))
-        Q_small = np.matmul(np.matmul(V, Epsilon), V.transpose())
-        Q[c, ch_idx] = Q_small[ch_idx == c, :]
+    rows, k = np.nonzero(valid)
+    Q[rows, neighbor_index[rows, k]] = Q_small[rows, own[rows], k]
     #return Q
-    return np.matmul(ts, Q.transpose())
\ No newline at end of file
+    return np.matmul(ts, Q.transpose().astype(ts.dtype))
\ No newline at end of file
@@ -55,6 +55,30 @@ def n_steps_neigh_channels(neighbors, steps):
     return neighChan_output
 
 
+def neighbor_index_array(neighbors):
+    """Convert a channel neighrborhood matrix to a padded index array
+    Parameters
+    ----------
+    neighbors: np.array
+        C x C boolean channel neighrborhood matrix
+
+    Returns
+    -------
+    np.array
+        C x K int32 array, where K is the largest number of neighbors
+        of a channel. Row c holds the neighbors of channel c in
+        increasing order, padded with -1
+    """
+    C = neighbors.shape[0]
+    counts = np.sum(neighbors, axis=1)
+    neigh_index = np.full((C, np.max(counts)), -1, dtype=np.int32)
+    rows, cols = np.nonzero(neighbors)
+    slots = np.arange(len(rows)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    neigh_index[rows, slots] = cols
+    return neigh_index
+
+
 def make_channel_groups(n_channels, neighbors, geom):
     channelGroups = list()
     c_left = np.array(range(n_channels))
@@ -1,22 +1,200 @@
+import concurrent.futures
+
 import numpy as np
 
-from scipy.signal import butter, lfilter
+from scipy.signal import sosfilt
 from scipy.spatial.distance import pdist, squareform
 from tqdm import *
 
-from geometry import find_channel_neighbors
+from geometry import (find_channel_neighbors, neighbor_index_array,
+                      n_steps_neigh_channels)
 from filtering import *
 
+try:
+    import numba
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # numba is optional, the kernels then run as plain python.
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
 def clean_spike_train(spt):
-    units = np.unique(spt[:, 1])
-    spt[:, 1] += len(units)
-    units += len(units)
-    for i, u in enumerate(units):
-        u_idx = spt[:, 1] == u
-        spt[u_idx, 1] = i
+    """Sorts a spike train by time and relabels its clusters.
+
+    Args:
+        spt: numpy.ndarray of shape [N, 2]. Spike times and cluster
+        ids.
+
+    Returns:
+        numpy.ndarray of shape [N, 2]. Spike train in time order whose
+        cluster ids are 0, ..., U-1, so spike times of every unit
+        selected from it are sorted as well.
+    """
+    spt = spt[np.argsort(spt[:, 0], kind='stable')]
+    _, cluster_ids = np.unique(spt[:, 1], return_inverse=True)
+    spt[:, 1] = cluster_ids.ravel()
     return spt
 
 
+def group_spike_train(spt, n_units):
+    """Groups the spike times of a clean spike train by unit.
+
+    Args:
+        spt: numpy.ndarray of shape [N, 2]. Spike train from
+        clean_spike_train, so it must be sorted by time and cluster
+        ids are 0, ..., n_units-1. Spike times of a unit are returned
+        unsorted otherwise.
+        n_units: int. Number of units in the spike train.
+
+    Returns:
+        times: numpy.ndarray of shape [N]. Spike times sorted by unit
+        and then by time.
+        boundaries: numpy.ndarray of shape [n_units+1]. Spike times of
+        unit u are times[boundaries[u]:boundaries[u+1]].
+    """
+    order = np.argsort(spt[:, 1], kind='stable')
+    boundaries = np.searchsorted(spt[order, 1], np.arange(n_units + 1))
+    return spt[order, 0], boundaries
+
+
+def window_in_batch(spike_times, window, n_samples):
+    """Masks spike times whose whole window falls inside a batch.
+
+    Args:
+        spike_times: numpy.ndarray of shape [N]. Spike times relative
+        to the start of the batch.
+        window: sequence of int. Sorted time offsets around a spike.
+        n_samples: int. Number of time samples in the batch.
+    """
+    lo, hi = window[0], window[-1] + 1
+    return np.logical_and(
+        spike_times + lo >= 0, spike_times + hi <= n_samples)
+
+
+@njit(cache=True, boundscheck=False)
+def _count_matches(array1, array2, admissible_proximity):
+    """Two pointer scan behind SpikeSortingEvaluation.count_matches."""
+    m, n = array1.shape[0], array2.shape[0]
+    i, j = 0, 0
+    count = 0
+    while i < m and j < n:
+        if abs(array1[i] - array2[j]) < admissible_proximity:
+            i += 1
+            j += 1
+            count += 1
+        elif array1[i] < array2[j]:
+            i += 1
+        else:
+            j += 1
+    return count
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _accumulate_snippets(templates, ts, times, boundaries, window_lo):
+    """Adds ts[times[k] + window, :] of the spikes of unit u, which are
+    times[boundaries[u]:boundaries[u+1]], to templates[:, :, u]."""
+    n_window, n_chan = templates.shape[0], templates.shape[1]
+    # Every thread owns whole units, so there are no races. Snippets
+    # are summed into a contiguous [len(window), C] buffer per unit so
+    # that the innermost loop runs over channels of a row of ts.
+    for u in prange(boundaries.shape[0] - 1):
+        acc = np.zeros((n_window, n_chan), dtype=templates.dtype)
+        for k in range(boundaries[u], boundaries[u + 1]):
+            t0 = times[k] + window_lo
+            for w in range(n_window):
+                for c in range(n_chan):
+                    acc[w, c] += ts[t0 + w, c]
+        for w in range(n_window):
+            for c in range(n_chan):
+                templates[w, c, u] += acc[w, c]
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _add_templates(ts, templates, times, cids, window_lo, block_starts):
+    """Adds templates[cids[k]] to ts[times[k] + window, :].
+
+    templates is unit major of shape [U, len(window), C] and times are
+    sorted. Spikes times[block_starts[j]:block_starts[j+1]] start in
+    time block j, whose length is at least len(window).
+    """
+    n_window, n_chan = templates.shape[1], templates.shape[2]
+    n_blocks = block_starts.shape[0] - 1
+    # Windows of a block only reach into the next block, so all even
+    # and then all odd blocks are added in parallel without races.
+    for parity in range(2):
+        for b in prange((n_blocks - parity + 1) // 2):
+            j = 2 * b + parity
+            for k in range(block_starts[j], block_starts[j + 1]):
+                t0 = times[k] + window_lo
+                u = cids[k]
+                for w in range(n_window):
+                    for c in range(n_chan):
+                        ts[t0 + w, c] += templates[u, w, c]
+
+
+def accumulate_snippets(templates, ts, spt, window):
+    """Sums the recording snippets of spikes per unit.
+
+    Args:
+        templates: numpy.ndarray of shape [len(window), C, U]. Sums
+        are accumulated into this array.
+        ts: numpy.ndarray of shape [T, C]. Batch of recording.
+        spt: numpy.ndarray of shape [N, 2]. Spike train relative to
+        the batch whose windows all fall inside the batch.
+        window: numpy.ndarray of consecutive time offsets.
+    """
+    if HAVE_NUMBA:
+        times, boundaries = group_spike_train(spt, templates.shape[2])
+        _accumulate_snippets(
+            templates, ts, times.astype(np.int64),
+            boundaries.astype(np.int64), window[0])
+    elif spt.shape[0]:
+        times, boundaries = group_spike_train(spt, templates.shape[2])
+        # Units with spikes in the batch and the start of their times.
+        units = np.flatnonzero(np.diff(boundaries))
+        starts = boundaries[units]
+        # Sum the [N, C] rows at each window offset per unit at once.
+        for w, offset in enumerate(window):
+            templates[w][:, units] += np.add.reduceat(
+                ts[times + offset], starts, axis=0).T
+
+
+def add_templates(ts, templates, spt, window):
+    """Adds the templates of units to the recording at spike times.
+
+    Args:
+        ts: numpy.ndarray of shape [T, C]. Batch of recording which
+        is modified in place.
+        templates: numpy.ndarray of shape [len(window), C, U].
+        spt: numpy.ndarray of shape [N, 2]. Spike train relative to
+        the batch whose windows all fall inside the batch.
+        window: numpy.ndarray of consecutive time offsets.
+    """
+    if HAVE_NUMBA:
+        spt = spt[np.argsort(spt[:, 0], kind='stable')]
+        starts = spt[:, 0] + window[0]
+        # Time blocks of at least len(window) samples, a few per thread.
+        block = max(len(window),
+                    -(-ts.shape[0] // (4 * numba.get_num_threads())))
+        block_starts = np.searchsorted(
+            starts, np.arange(0, ts.shape[0] + block, block))
+        _add_templates(
+            ts, np.ascontiguousarray(templates.transpose([2, 0, 1])),
+            spt[:, 0].astype(np.int64), spt[:, 1].astype(np.int64),
+            window[0], block_starts)
+    else:
+        # Overlapping windows rule out a single fancy-indexed add, and
+        # np.add.at is slower than adding one window slice per spike.
+        n_window = len(window)
+        for t, u in zip(spt[:, 0] + window[0], spt[:, 1]):
+            ts[t:t + n_window, :] += templates[:, :, u]
+
+
 class RecordingBatchIterator(object):
 
     def __init__(self, rec_file, geom_file, sample_rate,
@@ -45,26 +223,60 @@ class RecordingBatchIterator(object):
         self.geometry = np.genfromtxt(geom_file, delimiter=' ')
         self.neighbs = find_channel_neighbors(
             self.geometry, self.radius)
-        self.file = open(rec_file, 'r')
+        # Two steps neighbors of each channel used for whitening.
+        self._whiten_neighbs = neighbor_index_array(
+            n_steps_neigh_channels(self.neighbs, steps=2))
+        # Band-pass filter applied to every batch.
+        self._sos = butterworth_sos(
+            300, 0.1, 3, self.s_rate).astype(np.float32)
+        # Memory map of the recording of shape [T, n_chan].
+        self.recording = np.memmap(
+            rec_file, dtype=np.int16, mode='r').reshape([-1, n_chan])
+        # Start of the next batch that the prefetch thread reads, one
+        # batch ahead of what next_batch has returned.
+        self._cursor = 0
+        # Two float32 batch buffers, one is filled in the background
+        # while the other one is being filtered.
+        self._ts_buf = np.empty(
+            [2, batch_time_samples, n_chan], dtype=np.float32)
+        self._buf_slot = 0
+        self._pool = concurrent.futures.ThreadPoolExecutor(1)
+        self._next_future = self._pool.submit(self._read_raw)
+
+    def _read_raw(self):
+        """Reads the raw batch at the cursor and advances the cursor."""
+        raw = self.recording[
+            self._cursor:self._cursor + self.batch_time_samples]
+        self._cursor += self.batch_time_samples
+        ts = self._ts_buf[self._buf_slot, :raw.shape[0]]
+        self._buf_slot = 1 - self._buf_slot
+        np.copyto(ts, raw)
+        return ts
+
+    def _cancel_prefetch(self):
+        """Cancels or waits for the pending background read."""
+        self._next_future.cancel()
+        concurrent.futures.wait([self._next_future])
 
     def next_batch(self):
         """Gets the next temporal batch of recording."""
-        ts = np.fromfile(
-            self.file,
-            count= self.n_chan * self.batch_time_samples,
-            dtype=np.int16)
-        ts = np.reshape(ts, [self.batch_time_samples, self.n_chan])
-        ts = butterworth(ts, 300, 0.1, 3, self.s_rate)
-        ts = ts/np.std(ts)
-        ts = whitening(ts, self.neighbs, 40)
+        ts = self._next_future.result()
+        self._next_future = self._pool.submit(self._read_raw)
+        ts = sosfilt(self._sos, ts, axis=0)
+        ts *= np.float32(1.0 / np.std(ts))
+        ts = whitening(ts, self._whiten_neighbs, 40)
         return ts
 
     def reset_cursor(self):
-        """Resets the cursor of the open file to the beginning."""
-        self.file.seek(0)
+        """Resets the cursor of the recording to the beginning."""
+        self._cancel_prefetch()
+        self._cursor = 0
+        self._next_future = self._pool.submit(self._read_raw)
 
     def close_iterator(self):
-        self.file.close()
+        self._cancel_prefetch()
+        self._pool.shutdown()
+        del self.recording
 
 class MeanWaveCalculator(object):
 
@@ -79,10 +291,10 @@ class MeanWaveCalculator(object):
         """
         self.batch_reader = batch_reader
         self.spike_train = spike_train
-        self.window = range(-10, 30)
+        self.window = np.arange(-10, 30, dtype=np.intp)
         self.spike_train = clean_spike_train(
             self.spike_train)
-        self.n_units = max(self.spike_train[:, 1] + 1)
+        self.n_units = int(self.spike_train[:, 1].max()) + 1
         self.templates = np.zeros(
             [len(self.window), batch_reader.n_chan, self.n_units])
         print('Computing mean waveforms...')
@@ -101,19 +313,18 @@ class MeanWaveCalculator(object):
             spt = self.spike_train[batch_idx, :]
             spt[:, 0] -= n_samples * i
             ts = self.batch_reader.next_batch()
-            for j in range(spt.shape[0]):
-                try:
-                    self.templates[:, :, spt[j, 1]] += ts[spt[j, 0] + self.window, :]
-                    counts[spt[j, 1]] += 1
-                except:
-                    boundary_violation += 1
+            valid = window_in_batch(spt[:, 0], self.window, ts.shape[0])
+            boundary_violation += int(np.sum(~valid))
+            spt = spt[valid, :]
+            accumulate_snippets(self.templates, ts, spt, self.window)
+            counts += np.bincount(spt[:, 1], minlength=self.n_units)
         for u in range(self.n_units):
             if counts[u]:
                 self.templates[:, :, u] /= counts[u]
         return boundary_violation
 
     def close_reader(self):
-        self.batch_reader.close()
+        self.batch_reader.close_iterator()
 
 
 class RecordingAugmentation(object):
@@ -129,14 +340,49 @@ class RecordingAugmentation(object):
         self.n_chan = self.geometry.shape[0]
         self.template_calculator = mean_wave_calculator
         self.x_unit = 20.0
+        # Resolution to which channel coordinates are quantized.
+        self.coord_resolution = 1e-3
+        # Size in bytes of blocks written by save_augment_recording.
+        self.write_block_bytes = 16 * 1024 * 1024
         self.construct_channel_map()
         self.compute_stat_summary()
 
     def construct_channel_map(self):
-        """Constucts a map of coordinate to channel index."""
-        self.geom_map = {}
-        for i in range(self.n_chan):
-            self.geom_map[(self.geometry[i, 0], self.geometry[i, 1])] = i
+        """Constucts a map of coordinate to channel index.
+
+        Coordinates are quantized to integers and each channel is
+        given a single integer key, ordered by x and then y, so that
+        coordinates can be looked up with a binary search.
+        """
+        geom_int = np.round(
+            self.geometry / self.coord_resolution).astype(np.int64)
+        self._y_min = geom_int[:, 1].min()
+        self._y_span = geom_int[:, 1].max() - self._y_min + 1
+        self._geom_order = np.lexsort((geom_int[:, 1], geom_int[:, 0]))
+        geom_int = geom_int[self._geom_order]
+        self._geom_keys = (geom_int[:, 0] * self._y_span +
+                           geom_int[:, 1] - self._y_min)
+
+    def find_channels(self, coords):
+        """Finds the channels located at the given coordinates.
+
+        Args:
+            coords: numpy.ndarray of shape [N, 2].
+
+        Returns:
+            numpy.ndarray of shape [N]. Channel index at each coordinate
+            and -1 where there is no channel.
+        """
+        coords_int = np.round(
+            coords / self.coord_resolution).astype(np.int64)
+        y = coords_int[:, 1] - self._y_min
+        keys = coords_int[:, 0] * self._y_span + y
+        pos = np.minimum(np.searchsorted(self._geom_keys, keys),
+                         len(self._geom_keys) - 1)
+        found = np.logical_and(
+            self._geom_keys[pos] == keys,
+            np.logical_and(y >= 0, y < self._y_span))
+        return np.where(found, self._geom_order[pos], -1)
 
     def move_spatial_trace(self, template, dist, spatial_size=10, mode='amp'):
         """Moves the waveform spatially around the probe.
@@ -152,18 +398,13 @@ class RecordingAugmentation(object):
             location = np.argsort(
                 np.max(np.abs(template), axis=0))[-spatial_size:]
         x_move = dist * self.x_unit
-        # the vector of translation from original location to new one.
-        trans = np.zeros([len(location), 2]).astype('int') - 1
-        trans[:, 0] = location
-        for i, l in enumerate(location):
-            candidate = (self.geometry[l, 0] + x_move, self.geometry[l, 1])
-            if candidate in self.geom_map:
-                trans[i, 1] = self.geom_map[candidate]
-            else:
-                continue
-        idx_origin = trans[trans[:, 1] >= 0, 0]
-        idx_moved = trans[trans[:, 1] >=0, 1]
-        new_temp[:, idx_moved] = template[:, idx_origin]
+        # Channels at the new location of each main channel, -1 where
+        # the translation moves off the probe.
+        moved_to = self.find_channels(
+            self.geometry[location] + np.array([x_move, 0]))
+        valid = moved_to >= 0
+        new_temp[:, moved_to[valid]] = np.take(
+            template, location[valid], axis=1)
         return new_temp
 
     def compute_stat_summary(self):
@@ -180,23 +421,32 @@ class RecordingAugmentation(object):
             devation of the log-normal and the total count of spikes
             for units.
         """
-        self.stat_summary = np.zeros(
-            [self.template_comp.n_units, 3])
-        spt = self.template_comp.spike_train
-        for u in range(self.template_comp.n_units):
-            # spike train of unit u
-            spt_u = np.sort(spt[spt[:, 1] == u, 0])
-            if len(spt > 2):
-                # We estimate the difference between
-                # consecutive firing times of the same unit
-                u_firing_diff = spt_u[1:] - spt_u[:-1]
-                # Getting rid of duplicates.
-                # TODO: do this more sensibly.
-                u_firing_diff[u_firing_diff == 0] = 1
-                u_firing_diff = np.log(u_firing_diff)
-                u_mean = np.mean(u_firing_diff)
-                u_std = np.std(u_firing_diff)
-                self.stat_summary[u, :] = u_mean, u_std, len(spt_u)
+        n_units = self.template_comp.n_units
+        self.stat_summary = np.zeros([n_units, 3])
+        times, boundaries = group_spike_train(
+            self.template_comp.spike_train, n_units)
+        counts = np.diff(boundaries)
+        # We estimate the difference between consecutive firing
+        # times of the same unit. Differences between the last spike
+        # of a unit and the first spike of the next one are dropped.
+        unit = np.repeat(np.arange(n_units), counts)
+        same_unit = unit[1:] == unit[:-1]
+        u_firing_diff = np.diff(times)[same_unit]
+        unit = unit[1:][same_unit]
+        # Getting rid of duplicates.
+        # TODO: do this more sensibly.
+        u_firing_diff[u_firing_diff == 0] = 1
+        u_firing_diff = np.log(u_firing_diff)
+        n_diff = np.maximum(counts - 1, 1)
+        u_mean = np.bincount(
+            unit, weights=u_firing_diff, minlength=n_units) / n_diff
+        u_std = np.sqrt(np.bincount(
+            unit, weights=(u_firing_diff - u_mean[unit]) ** 2,
+            minlength=n_units) / n_diff)
+        valid = counts > 2
+        self.stat_summary[valid, 0] = u_mean[valid]
+        self.stat_summary[valid, 1] = u_std[valid]
+        self.stat_summary[valid, 2] = counts[valid]
         return self.stat_summary
 
     def make_fake_spike_train(self, augment_rate = 0.25):
@@ -207,27 +457,34 @@ class RecordingAugmentation(object):
             per unit (percentage of total spikes per unit).
         """
         refractory_period = 60
-        spt = self.template_comp.spike_train
-        # We sample a new set of spike times per cluster.
-        times = []
-        cid = []
-        for u in range(self.template_comp.n_units):
-            spt_u = np.sort(spt[spt[:, 1] == u, 0])
-            new_spike_count = int(
-                self.stat_summary[u, 2] * augment_rate)
-            diffs = np.exp(np.random.normal(
-                self.stat_summary[u, 0],
-                self.stat_summary[u, 1],
-                new_spike_count)).astype('int')
-            # Offsets for adding new spikes based on the
-            # sampled differential times.
-            offsets = np.sort(
-                np.random.choice(spt_u, new_spike_count, replace=False))
-            
-            diffs[diffs < refractory_period] += refractory_period
-            times += list(offsets + diffs)
-            cid += [u] * new_spike_count
-        return np.array([times, cid]).T
+        n_units = self.template_comp.n_units
+        spt_times, boundaries = group_spike_train(
+            self.template_comp.spike_train, n_units)
+        # We sample a new set of spike times per cluster,
+        # all clusters are drawn at once.
+        new_spike_count = (
+            self.stat_summary[:, 2] * augment_rate).astype('int')
+        if np.any(new_spike_count > np.diff(boundaries)):
+            raise ValueError(
+                'augment_rate {} asks for more spikes than a unit '
+                'has.'.format(augment_rate))
+        cid = np.repeat(np.arange(n_units), new_spike_count)
+        diffs = np.exp(np.random.normal(
+            self.stat_summary[cid, 0],
+            self.stat_summary[cid, 1])).astype('int')
+        # Offsets for adding new spikes based on the
+        # sampled differential times. Spikes are shuffled within
+        # each unit and the first new_spike_count of them are taken,
+        # i.e. a sample without replacement per unit.
+        unit = np.repeat(np.arange(n_units), np.diff(boundaries))
+        shuffled = np.lexsort((np.random.rand(len(unit)), unit))
+        first = np.arange(len(cid)) + np.repeat(
+            boundaries[:-1] - np.cumsum(new_spike_count) + new_spike_count,
+            new_spike_count)
+        # Sorting the picked indices sorts the offsets of each unit.
+        offsets = spt_times[np.sort(shuffled[first])]
+        diffs[diffs < refractory_period] += refractory_period
+        return np.array([offsets + diffs, cid]).T
 
     def save_augment_recording(
         self, out_file_name, length, move_rate=0.2, scale=1e3):
@@ -258,22 +515,29 @@ class RecordingAugmentation(object):
         temp_shape = self.template_comp.templates.shape
         moved_templates = np.zeros(
             [temp_shape[0], temp_shape[1], len(moved_units)])
-        # An array size of n_units where 0 indicates no movement
-        # otherwise the index of the moved template in the move_templates
-        # np.ndarray.
-        moved = np.zeros(n_units)
         for i, u in enumerate(moved_units):
-            moved[u] = i
             # Spatial distance is drawn from a poisson distribution.
             dist = np.sign(np.random.rand() - 0.5) * np.random.poisson(15)
             moved_templates[:, :, i] = self.move_spatial_trace(
                 orig_templates[:, :, u], dist)
+        # Templates that are added to the recording per unit, where
+        # moved units use their spatially moved template.
+        aug_templates = np.copy(orig_templates)
+        aug_templates[:, :, moved_units] = moved_templates
         # Create augmented spike train.
         aug_spt = self.make_fake_spike_train()
         reader = self.template_comp.batch_reader
         boundary_violation = 0
         n_samples = reader.batch_time_samples
-        f = open(out_file_name, 'w')
+        window = self.template_comp.window
+        # Batches are collected in a block of about 16MB and each
+        # full block is written to file with a single call.
+        block_batches = max(
+            1, self.write_block_bytes // (2 * n_samples * reader.n_chan))
+        out_buf = np.empty(
+            [block_batches * n_samples, reader.n_chan], dtype=np.int16)
+        n_filled = 0
+        f = open(out_file_name, 'wb')
         for i in tqdm(range(length)):
             batch_idx = np.logical_and(
                 aug_spt[:, 0] > i * n_samples,
@@ -281,24 +545,25 @@ class RecordingAugmentation(object):
             spt = aug_spt[batch_idx, :]
             spt[:, 0] -= n_samples * i
             ts = reader.next_batch()
-            for j in range(spt.shape[0]):
-                cid = spt[j, 1]
-                try:
-                    if moved[cid]:
-                        ts[spt[j, 0] + self.window, :] += moved_templates[:, :, moved[cid]]
-                    else:
-                        ts[spt[j, 0] + self.window, :] += orig_templates[:, :, cid]
-                except:
-                    boundary_violation += 1
-            ts *= scale
-            ts = ts.astype('int16')
-            ts.tofile(f)
+            valid = window_in_batch(spt[:, 0], window, ts.shape[0])
+            boundary_violation += int(np.sum(~valid))
+            spt = spt[valid, :]
+            add_templates(ts, aug_templates, spt, window)
+            np.multiply(ts, np.float32(scale), out=ts)
+            # Saturate at the int16 range instead of wrapping around.
+            np.clip(ts, -32768, 32767, out=ts)
+            np.copyto(out_buf[n_filled:n_filled + ts.shape[0]], ts,
+                      casting='unsafe')
+            n_filled += ts.shape[0]
+            if n_filled + n_samples > out_buf.shape[0]:
+                f.write(memoryview(out_buf[:n_filled]))
+                n_filled = 0
+        f.write(memoryview(out_buf[:n_filled]))
         # Reassign spikes from moved clusters to new units.
         new_unit_id = self.template_comp.n_units
-        for u in range(self.template_comp.n_units):
-            if moved[u]:
-                aug_spt[aug_spt[:, 1] == u, 1] = new_unit_id
-                new_unit_id += 1
+        for u in moved_units:
+            aug_spt[aug_spt[:, 1] == u, 1] = new_unit_id
+            new_unit_id += 1
         f.close()
         return np.append(
             self.template_comp.spike_train, aug_spt, axis=0)
@@ -318,14 +583,15 @@ class SpikeSortingEvaluation(object):
         # clean the spike train before calling this function.
         spt_base = clean_spike_train(spt_base)
         spt = clean_spike_train(spt)
-        self.n_units = np.max(spt_base[:, 1]) + 1
-        self.n_clusters = np.max(spt[:, 1]) + 1
+        self.n_units = int(spt_base[:, 1].max()) + 1
+        self.n_clusters = int(spt[:, 1].max()) + 1
         self.spt_base = spt_base
         self.spt = spt
         # Spike counts per unit and cluster
         self.spike_count_base = self.count_spikes(spt_base)
         self.spike_count_cluster = self.count_spikes(spt)
         # Compute matching and accuracies.
+        self.admissible_proximity = 60
         self.confusion_matrix = None
         self.compute_confusion_matrix()
         self.true_positive = np.zeros(self.n_units)
@@ -340,11 +606,10 @@ class SpikeSortingEvaluation(object):
             spt: numpy.ndarray of shape [N, 2]. Clean spike
             train where cluster ids are 0, ..., N-1.
         """
-        n_cluster = np.max(spt[:, 1]) + 1
-        counts = np.zeros(n_cluster)
-        for u in range(n_cluster):
-            counts[u] = np.sum(spt[:, 1] == u)
-        return counts
+        n_cluster = int(spt[:, 1].max()) + 1
+        counts = np.bincount(
+            spt[:, 1].astype(np.intp), minlength=n_cluster)
+        return counts.astype(np.float64)
 
     def compute_confusion_matrix(self):
         """Calculates the confusion matrix of two spike trains.
@@ -352,16 +617,32 @@ class SpikeSortingEvaluation(object):
         The first spike train is the instances original spike train.
         The second one is given as an argument. 
         """
+        prox = self.admissible_proximity
+        # self.spt comes from clean_spike_train and is in time order.
+        t_sorted = self.spt[:, 0]
+        c_sorted = self.spt[:, 1].astype(np.intp)
+        # For every base spike, the range of spikes in t_sorted that are
+        # strictly within the admissible proximity.
+        lo = np.searchsorted(t_sorted, self.spt_base[:, 0] - prox, 'right')
+        hi = np.searchsorted(t_sorted, self.spt_base[:, 0] + prox, 'left')
+        n_pairs = hi - lo
+        pair_idx = np.arange(np.sum(n_pairs)) + np.repeat(
+            lo - np.cumsum(n_pairs) + n_pairs, n_pairs)
+        # Units and clusters with at least one spike pair in proximity.
+        overlap = np.zeros([self.n_units, self.n_clusters], dtype=bool)
+        overlap[np.repeat(self.spt_base[:, 1], n_pairs),
+                c_sorted[pair_idx]] = True
+        # One-to-one matching is only needed where spikes overlap.
+        base_times, base_bounds = group_spike_train(
+            self.spt_base, self.n_units)
+        times, bounds = group_spike_train(self.spt, self.n_clusters)
         confusion_matrix = np.zeros(
             [self.n_units, self.n_clusters])
-        for unit in tqdm(range(self.n_units)):
-            idx = self.spt_base[:, 1] == unit
-            spike_times_base = self.spt_base[idx, 0]
-            for cluster in range(self.n_clusters):
-                idx = self.spt[:, 1] == cluster
-                spike_times_cluster = self.spt[idx, 0]
-                confusion_matrix[unit, cluster] = self.count_matches(
-                    spike_times_base, spike_times_cluster)
+        units, clusters = np.nonzero(overlap)
+        for unit, cluster in tqdm(zip(units, clusters), total=len(units)):
+            confusion_matrix[unit, cluster] = self.count_matches(
+                base_times[base_bounds[unit]:base_bounds[unit + 1]],
+                times[bounds[cluster]:bounds[cluster + 1]])
         self.confusion_matrix = confusion_matrix
 
     def count_matches(self, array1, array2):
@@ -371,20 +652,10 @@ class SpikeSortingEvaluation(object):
             int. Number of temporal collisions of spikes in
             array1 vs spikes in array2.
         """
-        self.admissible_proximity = 60
-        m, n = len(array1), len(array2)
-        i, j = 0, 0
-        count = 0
-        while i < m and j < n:
-            if abs(array1[i] - array2[j]) < self.admissible_proximity:
-                i += 1
-                j += 1
-                count += 1
-            elif array1[i] < array2[j]:
-                i += 1
-            else:
-                j += 1
-        return count
+        return _count_matches(
+            np.ascontiguousarray(array1, dtype=np.int64),
+            np.ascontiguousarray(array2, dtype=np.int64),
+            self.admissible_proximity)
 
     def compute_accuracies(self):
         """Computes the TP/FP accuracies for the given spike trains."""